@@ -3,8 +3,11 @@
 """Parse URLs for DOIs, PubMed identifiers, PMC identifiers, arXiv identifiers, etc."""
 
 import enum
+import re
 from collections import defaultdict
+from functools import lru_cache, partial
 from typing import (
+    Callable,
     DefaultDict,
     Dict,
     Iterable,
@@ -17,7 +20,7 @@ from typing import (
     Union,
     cast,
 )
-from urllib.parse import urlparse
+from urllib.parse import parse_qsl, urlsplit
 
 __all__ = [
     "parse",
@@ -28,36 +31,47 @@ __all__ = [
     "Result",
 ]
 
-RAW_DOI_PREFIXES = {"10.21203/", "10.26434/", "10.20944/", "10.21105/"}
+#: Prefixes for the identifiers given back by :func:`parse`
+NS_DOI = "doi"
+NS_PUBMED = "pubmed"
+NS_PMC = "pmc"
+NS_ARXIV = "arxiv"
+NS_BIORXIV = "biorxiv"
+NS_MEDRXIV = "medrxiv"
+
+RAW_DOI_PREFIXES = ("10.21203/", "10.26434/", "10.20944/", "10.21105/")
 
 SUFFIXES = [".pdf", ".full", ".full.pdf", ".article-metrics", "/pdf"]
+#: Suffixes with their lengths, longest first, so only one suffix ever needs to be
+#: stripped (e.g., ``.full.pdf`` in one go instead of ``.pdf`` then ``.full``)
+_SORTED_SUFFIXES = [(suffix, len(suffix)) for suffix in sorted(SUFFIXES, key=len, reverse=True)]
 
 PREFIXES = {
-    "doi.org/": "doi",
-    "biorxiv.org/lookup/doi/": "biorxiv",
-    "medrxiv.org/lookup/doi/": "medrxiv",
-    "jvi.asm.org/cgi/doi/": "doi",
-    "www.sciencemag.org/lookup/doi/": "doi",
-    "doi.wiley.com/": "doi",
-    "onlinelibrary.wiley.com/doi/full/": "doi",
-    "bmcsystbiol.biomedcentral.com/articles/": "doi",
-    "dx.plos.org/": "doi",
-    "www.nejm.org/doi/": "doi",
-    "onlinelibrary.wiley.com/doi/abs/": "doi",
-    "www.pnas.org/cgi/doi/": "doi",
-    "www.microbiologyresearch.org/content/journal/jgv/": "doi",
-    "link.springer.com/": "doi",
-    "jcm.asm.org/lookup/doi/": "doi",
-    "www.tandfonline.com/doi/": "doi",
-    "www.annualreviews.org/doi/": "doi",
-    "joss.theoj.org/papers/": "doi",
-    "bmcbioinformatics.biomedcentral.com/track/pdf/": "doi",
-    "www.frontiersin.org/articles/": "doi",
-    "arxiv.org/pdf/": "arxiv",
-    "arxiv.org/abs/": "arxiv",
-    "ar5iv.org/abs/": "arxiv",
-    "ar5iv.org/pdf/": "arxiv",
-    "ar5iv.org/html/": "arxiv",
+    "doi.org/": NS_DOI,
+    "biorxiv.org/lookup/doi/": NS_BIORXIV,
+    "medrxiv.org/lookup/doi/": NS_MEDRXIV,
+    "jvi.asm.org/cgi/doi/": NS_DOI,
+    "www.sciencemag.org/lookup/doi/": NS_DOI,
+    "doi.wiley.com/": NS_DOI,
+    "onlinelibrary.wiley.com/doi/full/": NS_DOI,
+    "bmcsystbiol.biomedcentral.com/articles/": NS_DOI,
+    "dx.plos.org/": NS_DOI,
+    "www.nejm.org/doi/": NS_DOI,
+    "onlinelibrary.wiley.com/doi/abs/": NS_DOI,
+    "www.pnas.org/cgi/doi/": NS_DOI,
+    "www.microbiologyresearch.org/content/journal/jgv/": NS_DOI,
+    "link.springer.com/": NS_DOI,
+    "jcm.asm.org/lookup/doi/": NS_DOI,
+    "www.tandfonline.com/doi/": NS_DOI,
+    "www.annualreviews.org/doi/": NS_DOI,
+    "joss.theoj.org/papers/": NS_DOI,
+    "bmcbioinformatics.biomedcentral.com/track/pdf/": NS_DOI,
+    "www.frontiersin.org/articles/": NS_DOI,
+    "arxiv.org/pdf/": NS_ARXIV,
+    "arxiv.org/abs/": NS_ARXIV,
+    "ar5iv.org/abs/": NS_ARXIV,
+    "ar5iv.org/pdf/": NS_ARXIV,
+    "ar5iv.org/html/": NS_ARXIV,
 }
 IRRECONCILABLE = [
     "www.pnas.org/content/pnas/early/",
@@ -70,7 +84,14 @@ IRRECONCILABLE = [
     "msb.embopress.org/content/msb/",
 ]
 
-PROTOCOLS = {"https://", "http://"}
+PROTOCOLS = ("https://", "http://")
+
+#: Version tags that get stripped from the ends of identifiers, e.g., ``.v2`` in
+#: ``10.21203/rs.3.rs-123.v2``, ``v2`` in bioRxiv's ``2020.01.01.123456v2``, and
+#: ``/v2`` in preprints.org's ``202001.0001/v2``
+_DOI_VERSION_RE = re.compile(r"\.v[0-9]\Z")
+_BIORXIV_VERSION_RE = re.compile(r"v[0-9]\Z")
+_PREPRINTS_VERSION_RE = re.compile(r"/v[0-9]\Z")
 
 
 class Status(enum.Enum):
@@ -92,6 +113,10 @@ class Result(NamedTuple):
     identifier: str
 
 
+Handler = Callable[[str], Union[Status, Tuple[str, str]]]
+
+
+@lru_cache(maxsize=65536)
 def parse(url: str) -> Result:
     """Normalize a citation string that might be a crazy URL from a publisher.
 
@@ -102,6 +127,9 @@ def parse(url: str) -> Result:
 
     Ideally, this function should be able to parse a huge amount of garbage.
 
+    Since citation lists often contain the same URL many times, results are
+    cached. Use ``parse.cache_clear()`` to empty the cache.
+
     >>> parse("https://joss.theoj.org/papers/10.21105/joss.01708")
     ('doi', '10.21105/joss.01708')
 
@@ -117,137 +145,179 @@ def parse(url: str) -> Result:
     >>> parse("http://www.biorxiv.org/content/biorxiv/early/2017/08/09/174094.full.pdf")
     ('doi', '10.1101/174094')
     """
-    if url.isnumeric():
-        return Result(Status.success, "pubmed", url)
-
-    for protocol in PROTOCOLS:
-        if url.startswith(protocol):
-            rv = _handle(url[len(protocol) :])
-            if isinstance(rv, Status):
-                return Result(rv, None, url)
-            else:
-                return Result(Status.success, *rv)
-
-    for doi_prefix in RAW_DOI_PREFIXES:
-        if url.endswith(".pdf"):
-            url = url[: -len(".pdf")]
-        if url.startswith(doi_prefix):
-            for version in range(10):
-                if url.endswith(f".v{version}"):
-                    url = url[: -len(f".v{version}")]
-            return Result(Status.success, "doi", url)
+    if url.isdecimal():
+        return Result(Status.success, NS_PUBMED, url)
+
+    if url.startswith(PROTOCOLS):
+        rv = _handle(url.partition("://")[2])
+        if isinstance(rv, Status):
+            return Result(rv, None, url)
+        else:
+            return Result(Status.success, *rv)
+
+    url = url.removesuffix(".pdf")
+    if url.startswith(RAW_DOI_PREFIXES):
+        url = _DOI_VERSION_RE.sub("", url)
+        return Result(Status.success, NS_DOI, url)
 
     return Result(Status.unknown, None, url)
 
 
 def _handle(url: str) -> Union[Status, Tuple[str, str]]:
-    if any(url.startswith(x) for x in IRRECONCILABLE):
-        return Status.irreconcilable
-
-    for suffix in SUFFIXES:
+    for suffix, suffix_length in _SORTED_SUFFIXES:
         if url.endswith(suffix):
-            url = url[: -len(suffix)]
+            url = url[:-suffix_length]
+            break
+    match = _match_prefix(url)
+    if match is None:
+        return Status.unknown
+    end, handler = match
+    return handler(url[end:])
+
+
+def _match_prefix(url: str) -> Optional[Tuple[int, Handler]]:
+    """Find the longest prefix in :data:`HANDLERS` matching the beginning of the URL."""
+    match = _PREFIX_RE.match(url)
+    if match is None:
+        return None
+    return match.end(), HANDLERS[_SORTED_PREFIXES[cast(int, match.lastindex) - 1]]
+
 
-    if url.startswith("www.jbc.org/content/") and all(x.isnumeric() for x in url.split("/")[2:]):
+def _irreconcilable(_url: str) -> Status:
+    return Status.irreconcilable
+
+
+def _handle_namespace(prefix: str, url: str) -> Tuple[str, str]:
+    return prefix, url
+
+
+def _handle_jbc(url: str) -> Status:
+    if all(x.isnumeric() for x in url.split("/")):
         return Status.irreconcilable
+    return Status.unknown
+
+
+def _handle_jbc_early(url: str) -> Union[Status, Tuple[str, str]]:
+    parts = url.split("/")  # first 3 are dates, forth should be what we want
+    if len(parts) < 4:
+        return Status.unknown
+    return NS_DOI, f"10.1074/{parts[3]}"
+
+
+def _handle_pubmed(url: str) -> Tuple[str, str]:
+    if "," in url:
+        url = url.split(",")[0]
+    return NS_PUBMED, url
+
+
+def _handle_pmc(url: str) -> Tuple[str, str]:
+    return NS_PMC, url.split("/")[0]
+
 
-    if url.startswith("www.ncbi.nlm.nih.gov/pubmed/"):
-        pubmed_id = url[len("www.ncbi.nlm.nih.gov/pubmed/") :]
-        if "," in pubmed_id:
-            pubmed_id = pubmed_id.split(",")[0]
-        return "pubmed", pubmed_id
-
-    for prefix, ns in PREFIXES.items():
-        if url.startswith(prefix):
-            return ns, url[len(prefix) :]
-
-    if url.startswith("www.ncbi.nlm.nih.gov/pmc/articles/"):
-        url = url[len("www.ncbi.nlm.nih.gov/pmc/articles/") :]
-        url = url.split("/")[0]
-        return "pmc", url
-
-    for prefix in (
-        "www.biorxiv.org/content/early/",
-        "www.biorxiv.org/content/biorxiv/early/",
-    ):
-        if url.startswith(prefix):
-            url = url[len(prefix) :]
-            parts = url.split("/")  # first 3 are dates, forth should be what we want
-            biorxiv_id = parts[3]
-            if "v" in biorxiv_id:
-                biorxiv_id = biorxiv_id.split("v")[0]
-            return "doi", f"10.1101/{biorxiv_id}"
-
-    if url.startswith("europepmc.org/article/PMC/"):
-        pmc_id = url[len("europepmc.org/article/PMC/") :]
-        return "pmc", f"PMC{pmc_id}"
-
-    if url.lower().startswith("europepmc.org/articles/pmc"):
-        url = url[len("europepmc.org/articles/pmc") :]
-        pmc_id = url.split("?")[0]
-        return "pmc", f"PMC{pmc_id}"
-
-    if url.startswith("www.jbc.org/content/early/"):
-        url = url[len("www.jbc.org/content/early/") :]
-        parts = url.split("/")  # first 3 are dates, forth should be what we want
-        return "doi", f"10.1074/{parts[3]}"
-
-    if url.startswith("www.biorxiv.org/content/"):
-        url = url[len("www.biorxiv.org/content/") :]
-        for v in range(10):
-            if url.endswith(f"v{v}"):
-                url = url[: -len(f"v{v}")]
-        return "doi", url
-
-    if url.startswith("www.preprints.org/manuscript/"):
-        url = url[len("www.preprints.org/manuscript/") :]
-        for v in range(10):
-            if url.endswith(f"/v{v}"):
-                url = url[: -len(f"/v{v}")]
-        return "doi", f"10.20944/preprints{url}"
-
-    if url.startswith("www.frontiersin.org/article/"):
-        url = url[len("www.frontiersin.org/article/") :]
-        if url.endswith("/full"):
-            url = url[: -len("/full")]
-        return "doi", url
-
-    if url.startswith("www.nature.com/articles/"):
-        url = url[len("www.nature.com/articles/") :]
-        if url.endswith(".pdf"):
-            url = url[: -len(".pdf")]
-        return "doi", f"10.1038/{url}"
-
-    if url.startswith("journals.plos.org/ploscompbiol/article/file"):
-        query = _get_query(url)
-        return "doi", query["id"]
-
-    if url.startswith("elifesciences.org/download/"):
-        url = url[len("elifesciences.org/download/") :]
-        part = url.split("/")[1]
-        part = part.split("?")[0]
-        elife_id = part.split("-")[1]
-        return "doi", f"10.7554/eLife.{elife_id}"
-
-    if url.startswith("eutils.ncbi.nlm.nih.gov/entrez/eutils/elink.fcgi"):
-        query = _get_query(url)
-        if query.get("dbfrom") == "pubmed":
-            return "pubmed", query["id"]
+def _handle_europepmc_article(url: str) -> Tuple[str, str]:
+    return NS_PMC, f"PMC{url}"
 
+
+def _handle_europepmc_articles(url: str) -> Tuple[str, str]:
+    pmc_id = url.split("?")[0]
+    return NS_PMC, f"PMC{pmc_id}"
+
+
+def _handle_biorxiv_early(url: str) -> Union[Status, Tuple[str, str]]:
+    parts = url.split("/")  # first 3 are dates, forth should be what we want
+    if len(parts) < 4:
+        return Status.unknown
+    biorxiv_id = parts[3]
+    if "v" in biorxiv_id:
+        biorxiv_id = biorxiv_id.split("v")[0]
+    return NS_DOI, f"10.1101/{biorxiv_id}"
+
+
+def _handle_biorxiv(url: str) -> Tuple[str, str]:
+    return NS_DOI, _BIORXIV_VERSION_RE.sub("", url)
+
+
+def _handle_preprints(url: str) -> Tuple[str, str]:
+    url = _PREPRINTS_VERSION_RE.sub("", url)
+    return NS_DOI, f"10.20944/preprints{url}"
+
+
+def _handle_frontiersin(url: str) -> Tuple[str, str]:
+    url = url.removesuffix("/full")
+    return NS_DOI, url
+
+
+def _handle_nature(url: str) -> Tuple[str, str]:
+    url = url.removesuffix(".pdf")
+    return NS_DOI, f"10.1038/{url}"
+
+
+def _handle_plos(url: str) -> Tuple[str, str]:
+    query = _get_query(url)
+    return NS_DOI, query["id"]
+
+
+def _handle_elife(url: str) -> Tuple[str, str]:
+    part = url.split("/")[1]
+    part = part.split("?")[0]
+    elife_id = part.split("-")[1]
+    return NS_DOI, f"10.7554/eLife.{elife_id}"
+
+
+def _handle_eutils(url: str) -> Union[Status, Tuple[str, str]]:
+    query = _get_query(url)
+    if query.get("dbfrom") == "pubmed":
+        return NS_PUBMED, query["id"]
     return Status.unknown
 
 
+#: A mapping from URL prefixes (without protocols) to the functions that
+#: handle the rest of the URL after the prefix. If several prefixes match
+#: a given URL, the longest one wins.
+HANDLERS: Dict[str, Handler] = {
+    **{prefix: _irreconcilable for prefix in IRRECONCILABLE},
+    **{prefix: partial(_handle_namespace, ns) for prefix, ns in PREFIXES.items()},
+    "www.jbc.org/content/": _handle_jbc,
+    "www.jbc.org/content/early/": _handle_jbc_early,
+    "www.ncbi.nlm.nih.gov/pubmed/": _handle_pubmed,
+    "www.ncbi.nlm.nih.gov/pmc/articles/": _handle_pmc,
+    "europepmc.org/article/PMC/": _handle_europepmc_article,
+    "europepmc.org/articles/pmc": _handle_europepmc_articles,
+    "www.biorxiv.org/content/": _handle_biorxiv,
+    "www.biorxiv.org/content/early/": _handle_biorxiv_early,
+    "www.biorxiv.org/content/biorxiv/early/": _handle_biorxiv_early,
+    "www.preprints.org/manuscript/": _handle_preprints,
+    "www.frontiersin.org/article/": _handle_frontiersin,
+    "www.nature.com/articles/": _handle_nature,
+    "journals.plos.org/ploscompbiol/article/file": _handle_plos,
+    "elifesciences.org/download/": _handle_elife,
+    "eutils.ncbi.nlm.nih.gov/entrez/eutils/elink.fcgi": _handle_eutils,
+}
+#: Prefixes in :data:`HANDLERS` that are matched without regard to case
+CASE_INSENSITIVE_PREFIXES = {"europepmc.org/articles/pmc"}
+
+#: Since :mod:`re` tries alternatives from left to right, the longest prefixes are put first
+_SORTED_PREFIXES = sorted(HANDLERS, key=len, reverse=True)
+#: A single anchored alternation over all prefixes, with one group per prefix
+#: so the position of the matched group gives the handler
+_PREFIX_RE = re.compile(
+    "|".join(
+        f"((?i:{re.escape(prefix)}))"
+        if prefix in CASE_INSENSITIVE_PREFIXES
+        else f"({re.escape(prefix)})"
+        for prefix in _SORTED_PREFIXES
+    )
+)
+
+
 def _get_query(url: str) -> Mapping[str, str]:
-    query = {}
-    for part in urlparse(url.replace("&amp;", "&")).query.split("&"):
-        key, value = part.split("=")
-        query[key] = value
-    return query
+    # some exports HTML-escape the ampersands between query parameters
+    return dict(parse_qsl(urlsplit(url.replace("&amp;", "&")).query, keep_blank_values=True))
 
 
 def sort_key(item: Result) -> Tuple[int, str, str]:
     """Sort results."""
-    if item.status == Status.success:
+    if item.status is Status.success:
         return 0, cast(str, item.prefix), item.identifier
     else:
         return 1, "", item.identifier
@@ -258,15 +328,36 @@ def group(urls: Iterable[str], *, keep_none: bool = True) -> Dict[Union[str, Sta
     rv: DefaultDict[Union[str, Status], Set[str]] = defaultdict(set)
     for url in urls:
         result_type, prefix, identifier = parse(url)
-        if result_type == Status.success:
+        if result_type is Status.success:
             rv[cast(str, prefix)].add(identifier)
         elif keep_none:
             rv[result_type].add(identifier)
     return dict(rv)
 
 
-def parse_many(urls: Iterable[str], pre_sort: bool = False) -> List[Result]:
-    """Parse an iterable of URLs."""
+def parse_many(
+    urls: Iterable[str], pre_sort: bool = False, workers: Optional[int] = None
+) -> List[Result]:
+    """Parse an iterable of URLs.
+
+    :param urls: An iterable of URLs or other strings that can be interpreted as citations
+    :param pre_sort: Should the URLs be sorted before parsing?
+    :param workers: If given, parse in this many processes. This is only worth it
+        for very large collections of URLs, since each process has its own cache.
+    :returns: A list of results, in the same order as the URLs
+    :raises ValueError: If ``workers`` is less than one
+    """
     if pre_sort:
         urls = sorted(urls)
-    return [parse(url) for url in urls]
+    if workers is None:
+        return list(map(parse, urls))
+    if workers < 1:
+        raise ValueError(f"workers must be at least 1, got {workers}")
+
+    # only loaded when needed since importing multiprocessing is slow
+    from concurrent.futures import ProcessPoolExecutor
+
+    urls = list(urls)
+    chunksize = max(1, len(urls) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(parse, urls, chunksize=chunksize))
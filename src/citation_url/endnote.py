@@ -1,87 +1,328 @@
 """Interface to EndNote."""
 
+import logging
+import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+from logging.handlers import MemoryHandler
 from pathlib import Path
-from typing import Dict, Iterable, Set, Union
+from typing import Dict, Iterable, List, Set, Tuple, Union
 
-import click
 from defusedxml import ElementTree
 
-from citation_url import Status, group
+from citation_url import (
+    NS_ARXIV,
+    NS_BIORXIV,
+    NS_DOI,
+    NS_PMC,
+    NS_PUBMED,
+    Status,
+    group,
+)
+
+logger = logging.getLogger(__name__)
+
+#: Tags of the elements whose ``<url>`` children get parsed
+URL_TAGS = {"text-urls", "pdf-urls"}
+
+#: How many times to try uploading a publication when requests fail
+MAX_ATTEMPTS = 5
+#: The longest time in seconds to wait between attempts
+MAX_RETRY_DELAY = 60.0
+
+#: Wikidata properties for each identifier type, used to find existing items
+WIKIDATA_PROPERTIES = {
+    "pmcid": "P932",
+    "doi": "P356",
+    "pmid": "P698",
+    "arxiv": "P818",
+    "biorxiv": "P3951",
+}
 
 
 def process_endnote_xml(
     path: Union[str, Path], keep_none: bool = False
 ) -> Dict[Union[str, Status], Set[str]]:
-    """Extract all URLs from an EndNote XML file."""
-    tree = ElementTree.parse(path)
-    groups = group(
-        (
-            element.text
-            for query in ("text-urls", "pdf-urls")
-            for element in tree.findall(f"records/record/urls/{query}/url")
-            if element.text and element.text.startswith("http")
-        ),
-        keep_none=keep_none,
-    )
-    groups.setdefault("doi", set()).update(
-        element.text
-        for element in tree.findall("records/record/electronic-resource-num")
-        if element.text
-    )
-    return groups
+    """Extract all URLs from an EndNote XML file.
 
+    :param path: The path to an EndNote XML export
+    :param keep_none: Should URLs that couldn't be parsed be kept, grouped
+        under their :class:`Status`?
+    :returns: A dictionary from prefixes to sets of identifiers
 
-def endnote_to_wikidata(path: Union[str, Path]):
-    """Ensure the contents of the EndNote XML file are added to Wikidata."""
-    groups = process_endnote_xml(path=path, keep_none=False)
-    _upload_wikidata(
-        id_type="pmcid",
-        source="europepmc",
-        identifiers=[_removeprefix(x, "PMC") for x in groups.get("pmc", [])],
-    )
-    _upload_wikidata(id_type="doi", source="crossref", identifiers=groups.get("doi", []))
-    _upload_wikidata(id_type="pmid", source="europepmc", identifiers=groups.get("pubmed", []))
-    _upload_wikidata(id_type="arxiv", source="arxiv", identifiers=groups.get("arxiv", []))
-    _upload_wikidata(id_type="biorxiv", source="biorxiv", identifiers=groups.get("biorxiv", []))
+    The file is streamed, and each record's contents are cleared as soon as
+    it has been read, so only the emptied record elements are kept around.
+    """
+    urls: List[str] = []
+    dois: Set[str] = set()
+    for _, element in ElementTree.iterparse(path, events=("end",)):
+        if element.tag in URL_TAGS:
+            urls.extend(
+                url.text
+                for url in element.iterfind("url")
+                if url.text and url.text.startswith("http")
+            )
+        elif element.tag == "electronic-resource-num":
+            if element.text:
+                dois.add(element.text)
+        elif element.tag == "record":
+            element.clear()
+    groups = group(urls, keep_none=keep_none)
+    groups.setdefault(NS_DOI, set()).update(dois)
+    return groups
 
 
-def _removeprefix(s: str, prefix: str) -> str:
-    if s.startswith(prefix):
-        return s[len(prefix) :]
-    return s
+def endnote_to_wikidata(path: Union[str, Path], max_workers: int = 4):
+    """Ensure the contents of the EndNote XML file are added to Wikidata.
+
+    :param path: The path to the EndNote XML file
+    :param max_workers: The number of uploads that can be in flight at the same time
+    """
+    groups = process_endnote_xml(path=path, keep_none=False)
+    uploads = [
+        ("pmcid", "europepmc", [x.removeprefix("PMC") for x in groups.get(NS_PMC, [])]),
+        ("doi", "crossref", groups.get(NS_DOI, [])),
+        ("pmid", "europepmc", groups.get(NS_PUBMED, [])),
+        ("arxiv", "arxiv", groups.get(NS_ARXIV, [])),
+        ("biorxiv", "biorxiv", groups.get(NS_BIORXIV, [])),
+    ]
+    for id_type, source, identifiers in uploads:
+        _upload_wikidata(
+            id_type=id_type, source=source, identifiers=identifiers, max_workers=max_workers
+        )
 
 
-def _upload_wikidata(id_type: str, source: str, identifiers: Iterable[str]):
+def _upload_wikidata(
+    id_type: str, source: str, identifiers: Iterable[str], max_workers: int = 4
+) -> None:
     import pystow
     from tqdm import tqdm
     from wikidataintegrator import wdi_login
-    from wikidataintegrator.wdi_helpers import PublicationHelper
 
     username = pystow.get_config("wikidata", "username")
     password = pystow.get_config("wikidata", "password")
 
+    identifiers = list(identifiers)
+    existing = _get_existing_qids(id_type, identifiers)
+    for identifier, qid in existing.items():
+        logger.info(f"{id_type}:{identifier}\twikidata:{qid}\tmessage: already exists")
+    identifiers = [identifier for identifier in identifiers if identifier not in existing]
+    if not identifiers:
+        return
+
     wikidata_login = wdi_login.WDLogin(username, password)
+    # Metadata lookups overlap across threads, but the login isn't thread-safe
+    # and Wikidata asks bots not to edit in parallel, so edits go one at a
+    # time and at most one every 3 seconds
+    edit_lock = threading.Lock()
+    rate_limiter = _RateLimiter(interval=3.0)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                _upload_one, id_type, source, identifier, wikidata_login, edit_lock, rate_limiter
+            )
+            for identifier in identifiers
+        ]
+        try:
+            for future in tqdm(
+                as_completed(futures), total=len(futures), desc=f"{id_type}/{source}"
+            ):
+                level, lines = future.result()
+                logger.log(level, "\n".join(lines))
+        except BaseException:
+            # Otherwise, leaving the with block waits for every queued upload,
+            # which would keep editing Wikidata after a Ctrl-C
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+
+def _get_existing_qids(
+    id_type: str, identifiers: Iterable[str], batch_size: int = 50
+) -> Dict[str, str]:
+    """Look up which identifiers already have Wikidata items, a batch at a time."""
+    from wikidataintegrator.wdi_core import WDItemEngine
+
+    prop = WIKIDATA_PROPERTIES.get(id_type)
+    if prop is None:
+        return {}
+    # Wikidata stores DOIs in upper case
+    normalized = {
+        (identifier.upper() if id_type == "doi" else identifier): identifier
+        for identifier in identifiers
+    }
+    rv = {}
+    for batch in _batched(normalized, batch_size):
+        values = " ".join(_sparql_string(value) for value in batch)
+        query = f"SELECT ?item ?id WHERE {{ VALUES ?id {{ {values} }} ?item wdt:{prop} ?id . }}"
+        try:
+            res = WDItemEngine.execute_sparql_query(query)
+            bindings = res["results"]["bindings"]
+        except Exception as e:
+            # Not knowing about an item only costs a redundant lookup later on
+            logger.warning(f"could not look up existing {id_type} items: {e}")
+            continue
+        for binding in bindings:
+            identifier = normalized[binding["id"]["value"]]
+            rv[identifier] = binding["item"]["value"].rsplit("/", 1)[-1]
+    return rv
+
+
+def _sparql_string(value: str) -> str:
+    escaped = (
+        value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\r", "\\r")
+    )
+    return f'"{escaped}"'
+
+
+def _batched(values: Iterable[str], n: int) -> Iterable[List[str]]:
+    it = iter(values)
+    while batch := list(islice(it, n)):
+        yield batch
 
-    for identifier in tqdm(identifiers, desc=f"{id_type}/{source}"):
+
+def _upload_one(
+    id_type: str,
+    source: str,
+    identifier: str,
+    wikidata_login,
+    edit_lock: threading.Lock,
+    rate_limiter: "_RateLimiter",
+) -> Tuple[int, List[str]]:
+    """Get or create the Wikidata item for a publication and return a log level and report."""
+    from wikidataintegrator.wdi_helpers import PublicationHelper
+
+    for attempt in range(MAX_ATTEMPTS):
         try:
             publication_helper = PublicationHelper(identifier, id_type=id_type, source=source)
-            qid, warnings, success = publication_helper.get_or_create(wikidata_login)
-            success = "success" if success is True else success
-            tqdm.write(f"{id_type}:{identifier}\twikidata:{qid}\tmessage: {success}")
-            for warning in warnings or []:
-                tqdm.write(f"    warning: {warning}")
-            time.sleep(3)
+            if publication_helper.e is not None:
+                # The metadata lookup already failed, so don't take up an edit slot
+                qid, warnings, success = None, [], publication_helper.e
+            else:
+                with edit_lock:
+                    rate_limiter.wait()
+                    qid, warnings, success = publication_helper.get_or_create(wikidata_login)
         except Exception as e:
-            tqdm.write(f"{id_type}:{identifier}")
-            tqdm.write(f"    failure: {e}")
+            return logging.ERROR, [f"{id_type}:{identifier}", f"    failure: {e}"]
+        # PublicationHelper doesn't raise, it hands back what went wrong
+        # in place of the success flag
+        if not _is_transient(success) or attempt + 1 == MAX_ATTEMPTS:
+            break
+        time.sleep(_get_retry_delay(success, attempt))
+    if success is True:
+        level = logging.WARNING if warnings else logging.INFO
+        success = "success"
+    else:
+        level = logging.ERROR
+    return level, [
+        f"{id_type}:{identifier}\twikidata:{qid}\tmessage: {success}",
+        *(f"    warning: {warning}" for warning in warnings or []),
+    ]
+
+
+def _is_transient(error) -> bool:
+    """Check if a failed request is worth retrying, i.e., it wasn't the request's own fault."""
+    from requests import ConnectionError, HTTPError, Timeout
+
+    if isinstance(error, (ConnectionError, Timeout)):
+        return True
+    if isinstance(error, HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+
+def _get_retry_delay(error, attempt: int) -> float:
+    """Get how long to wait before retrying a failed request.
+
+    :param error: The error from the failed request
+    :param attempt: The zero-based number of the attempt that failed
+    :returns: The number of seconds to wait
+
+    If the server said how long to wait with a ``Retry-After`` header (e.g.,
+    on HTTP 429 or 503), that is used. Otherwise, back off exponentially.
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdecimal():
+            return min(float(retry_after), MAX_RETRY_DELAY)
+    return min(2.0**attempt, MAX_RETRY_DELAY) + random.uniform(0, 1)  # noqa:S311
+
+
+class _RateLimiter:
+    """Space out calls across threads so one starts at most every ``interval`` seconds."""
+
+    def __init__(self, interval: float):
+        """Initialize the rate limiter.
 
+        :param interval: The minimum number of seconds between the starts of two calls
+        """
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
 
-@click.command()
-@click.argument("path", type=click.Path(path_type=Path))
-def main(path: Path):
+    def wait(self) -> None:
+        """Block until the next call is allowed to start."""
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class _TqdmMemoryHandler(MemoryHandler):
+    """Buffer log records and write each batch out above the progress bar."""
+
+    def flush(self) -> None:
+        """Write all buffered records with a single :func:`tqdm.write`, so the bar stays intact."""
+        from tqdm import tqdm
+
+        with self.lock:
+            if self.buffer:
+                tqdm.write("\n".join(self.format(record) for record in self.buffer))
+                self.buffer.clear()
+
+
+def main() -> None:
     """Ensure the papers in a EndNote XML are added to Wikidata."""
-    endnote_to_wikidata(path)
+    _get_command()()
+
+
+def _get_command():
+    # click is only imported when the CLI actually runs, so importing
+    # process_endnote_xml from library code doesn't pay for it
+    import click
+
+    @click.command()
+    @click.argument(
+        "path", type=click.Path(exists=True, dir_okay=False, readable=True, path_type=Path)
+    )
+    @click.option(
+        "--workers",
+        type=click.IntRange(min=1),
+        default=4,
+        show_default=True,
+        help="Number of uploads that can be in flight at the same time",
+    )
+    def command(path: Path, workers: int):
+        """Ensure the papers in a EndNote XML are added to Wikidata."""
+        # Buffer the per-publication reports so they're written in batches,
+        # and through tqdm so they don't draw over the progress bar
+        handler = _TqdmMemoryHandler(capacity=100)
+        previous_level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        try:
+            endnote_to_wikidata(path, max_workers=workers)
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(previous_level)
+            handler.close()
+
+    return command
 
 
 if __name__ == "__main__":
@@ -0,0 +1,227 @@
+"""Tests for the EndNote interface."""
+
+import logging
+import threading
+import time
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Optional
+from unittest import mock
+
+import requests
+
+from citation_url import Status
+from citation_url.endnote import (
+    _batched,
+    _get_existing_qids,
+    _RateLimiter,
+    _sparql_string,
+    _TqdmMemoryHandler,
+    _upload_one,
+    _upload_wikidata,
+    process_endnote_xml,
+)
+
+HERE = Path(__file__).parent.resolve()
+ENDNOTE_PATH = HERE.joinpath("fixtures", "endnote.xml")
+
+
+def _stub_upload_modules(tqdm=lambda iterable, **_: iterable):
+    """Stub out the modules that _upload_wikidata imports."""
+    wdi_login = SimpleNamespace(WDLogin=mock.Mock())
+    return mock.patch.dict(
+        "sys.modules",
+        {
+            "pystow": SimpleNamespace(get_config=mock.Mock(return_value="")),
+            "tqdm": SimpleNamespace(tqdm=tqdm),
+            "wikidataintegrator": SimpleNamespace(wdi_login=wdi_login),
+            "wikidataintegrator.wdi_login": wdi_login,
+        },
+    )
+
+
+def _stub_publication_helper(publication_helper):
+    """Stub out the PublicationHelper that _upload_one imports."""
+    wdi_helpers = SimpleNamespace(PublicationHelper=publication_helper)
+    return mock.patch.dict(
+        "sys.modules",
+        {
+            "wikidataintegrator": SimpleNamespace(wdi_helpers=wdi_helpers),
+            "wikidataintegrator.wdi_helpers": wdi_helpers,
+        },
+    )
+
+
+def _upload_one_stubbed():
+    """Upload a DOI without a login or any waiting between edits."""
+    return _upload_one(
+        "doi", "crossref", "10.1/a", None, threading.Lock(), _RateLimiter(interval=0.0)
+    )
+
+
+def _http_error(status_code: int, retry_after: Optional[str] = None) -> requests.HTTPError:
+    """Make the error requests raises for an HTTP error status."""
+    response = requests.Response()
+    response.status_code = status_code
+    if retry_after is not None:
+        response.headers["Retry-After"] = retry_after
+    return requests.HTTPError(response=response)
+
+
+class TestEndNote(unittest.TestCase):
+    """Tests for the EndNote interface."""
+
+    def test_process(self):
+        """Test extracting and grouping URLs from an EndNote XML file."""
+        self.assertEqual(
+            {
+                "doi": {"10.21105/joss.01708", "10.1038/s41586-020-2012-7"},
+                "pubmed": {"34739845"},
+                "arxiv": {"2006.13365"},
+                "pmc": {"PMC5731347"},
+            },
+            process_endnote_xml(ENDNOTE_PATH),
+        )
+
+    def test_process_keep_none(self):
+        """Test that unparsable URLs are kept when asked."""
+        groups = process_endnote_xml(ENDNOTE_PATH, keep_none=True)
+        self.assertEqual({"https://example.com/true-garbage"}, groups[Status.unknown])
+
+    def test_sparql_string(self):
+        """Test quoting values for a SPARQL query."""
+        self.assertEqual('"10.1/ABC"', _sparql_string("10.1/ABC"))
+        self.assertEqual('"a\\"b\\\\c"', _sparql_string('a"b\\c'))
+        self.assertEqual('"a\\nb\\rc"', _sparql_string("a\nb\rc"))
+
+    def test_batched(self):
+        """Test splitting values into batches."""
+        self.assertEqual([["a", "b"], ["c", "d"], ["e"]], list(_batched("abcde", 2)))
+        self.assertEqual([], list(_batched([], 2)))
+
+    def test_existing_qids_failed_batch(self):
+        """Test that a failed lookup only drops its own batch."""
+
+        def execute_sparql_query(query):
+            if "10.1/A" in query:
+                raise ValueError("timed out")
+            return {
+                "results": {
+                    "bindings": [
+                        {
+                            "id": {"value": "10.1/B"},
+                            "item": {"value": "http://www.wikidata.org/entity/Q1"},
+                        }
+                    ]
+                }
+            }
+
+        wdi_core = SimpleNamespace(
+            WDItemEngine=SimpleNamespace(execute_sparql_query=execute_sparql_query)
+        )
+        modules = {
+            "wikidataintegrator": SimpleNamespace(wdi_core=wdi_core),
+            "wikidataintegrator.wdi_core": wdi_core,
+        }
+        with mock.patch.dict("sys.modules", modules):
+            with self.assertLogs("citation_url.endnote", level="WARNING"):
+                existing = _get_existing_qids("doi", ["10.1/a", "10.1/b"], batch_size=1)
+        self.assertEqual({"10.1/b": "Q1"}, existing)
+
+    def test_upload_retry_after(self):
+        """Test that a rate-limited upload is retried after the time the server asks for."""
+        publication_helper = mock.Mock()
+        publication_helper.return_value.e = None
+        publication_helper.return_value.get_or_create.side_effect = [
+            (None, [], _http_error(429, retry_after="1")),
+            ("Q1", [], True),
+        ]
+        with _stub_publication_helper(publication_helper), mock.patch("time.sleep") as sleep:
+            report = _upload_one_stubbed()
+        self.assertEqual((logging.INFO, ["doi:10.1/a\twikidata:Q1\tmessage: success"]), report)
+        self.assertEqual(2, publication_helper.return_value.get_or_create.call_count)
+        sleep.assert_called_once_with(1.0)
+
+    def test_upload_no_retry_client_error(self):
+        """Test that an upload failing because of the request itself isn't retried."""
+        error = _http_error(404)
+        publication_helper = mock.Mock()
+        publication_helper.return_value.e = None
+        publication_helper.return_value.get_or_create.return_value = (None, [], error)
+        with _stub_publication_helper(publication_helper), mock.patch("time.sleep") as sleep:
+            level, _ = _upload_one_stubbed()
+        self.assertEqual(logging.ERROR, level)
+        self.assertEqual(1, publication_helper.return_value.get_or_create.call_count)
+        sleep.assert_not_called()
+
+    def test_upload_failed_lookup(self):
+        """Test that a failed metadata lookup doesn't try to edit Wikidata."""
+        publication_helper = mock.Mock()
+        publication_helper.return_value.e = _http_error(404)
+        with _stub_publication_helper(publication_helper):
+            level, _ = _upload_one_stubbed()
+        self.assertEqual(logging.ERROR, level)
+        publication_helper.assert_called_once()
+        publication_helper.return_value.get_or_create.assert_not_called()
+
+    def test_upload_wikidata(self):
+        """Test that only identifiers without an item are uploaded, and each is reported."""
+
+        def upload_one(id_type, source, identifier, *_):
+            return logging.INFO, [f"{id_type}:{identifier}"]
+
+        with _stub_upload_modules(), mock.patch(
+            "citation_url.endnote._get_existing_qids", return_value={"10.1/a": "Q1"}
+        ), mock.patch("citation_url.endnote._upload_one", side_effect=upload_one) as upload:
+            with self.assertLogs("citation_url.endnote", level="INFO") as logs:
+                _upload_wikidata("doi", "crossref", ["10.1/a", "10.1/b", "10.1/c"])
+        self.assertEqual({"10.1/b", "10.1/c"}, {c.args[2] for c in upload.call_args_list})
+        self.assertEqual(3, len(logs.records))
+
+    def test_upload_wikidata_interrupted(self):
+        """Test that queued uploads are cancelled when the run is interrupted."""
+
+        def interrupted_tqdm(iterable, **_):
+            next(iter(iterable))
+            raise KeyboardInterrupt
+
+        def upload_one(id_type, source, identifier, *_):
+            time.sleep(0.01)
+            return logging.INFO, [f"{id_type}:{identifier}"]
+
+        identifiers = [f"10.1/{i}" for i in range(20)]
+        with _stub_upload_modules(tqdm=interrupted_tqdm), mock.patch(
+            "citation_url.endnote._get_existing_qids", return_value={}
+        ), mock.patch("citation_url.endnote._upload_one", side_effect=upload_one) as upload:
+            with self.assertRaises(KeyboardInterrupt):
+                _upload_wikidata("doi", "crossref", identifiers, max_workers=1)
+        # the one that was reported, and at most one that was already running
+        self.assertLessEqual(upload.call_count, 2)
+
+    def test_rate_limiter(self):
+        """Test that the rate limiter spaces calls out by its interval."""
+        with mock.patch("time.monotonic", return_value=100.0), mock.patch("time.sleep") as sleep:
+            rate_limiter = _RateLimiter(interval=3.0)
+            for _ in range(3):
+                rate_limiter.wait()
+        self.assertEqual([mock.call(3.0), mock.call(6.0)], sleep.call_args_list)
+
+    def test_tqdm_memory_handler(self):
+        """Test that buffered records are written out together through tqdm."""
+        tqdm = mock.Mock()
+        handler = _TqdmMemoryHandler(capacity=2)
+        logger = logging.getLogger("citation_url.test_tqdm_memory_handler")
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            with mock.patch.dict("sys.modules", {"tqdm": SimpleNamespace(tqdm=tqdm)}):
+                logger.warning("a")
+                tqdm.write.assert_not_called()
+                logger.warning("b")
+                tqdm.write.assert_called_once_with("a\nb")
+                logger.error("c")
+                tqdm.write.assert_called_with("c")
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
@@ -3,9 +3,125 @@
 import unittest
 from typing import Iterable
 
+from parameterized import parameterized
+
 import citation_url
 from citation_url import IRRECONCILABLE, PREFIXES, PROTOCOLS, Result, Status
 
+#: URLs that can be parsed, with their expected prefixes and identifiers
+PARSE_DATA = [
+    (
+        "https://www.biorxiv.org/content/biorxiv/early/2020/03/30/2020.03.27.001834.full.pdf",
+        "doi",
+        "10.1101/2020.03.27.001834",
+    ),
+    (
+        "https://www.ncbi.nlm.nih.gov/pmc/articles/PMC5731347/pdf/MSB-13-954.pdf",
+        "pmc",
+        "PMC5731347",
+    ),
+    (
+        "10.21105/joss.01708.pdf",
+        "doi",
+        "10.21105/joss.01708",
+    ),
+    (
+        "https://joss.theoj.org/papers/10.21105/joss.01708.pdf",
+        "doi",
+        "10.21105/joss.01708",
+    ),
+    (
+        "https://journals.plos.org/ploscompbiol/article/file?id=10.1371/journal.pcbi.1007311&type=printable",
+        "doi",
+        "10.1371/journal.pcbi.1007311",
+    ),
+    (
+        "https://journals.plos.org/ploscompbiol/article/file?type=printable&id=10.1371/journal.pcbi.1007311",
+        "doi",
+        "10.1371/journal.pcbi.1007311",
+    ),
+    (
+        "https://journals.plos.org/ploscompbiol/article/file?id=10.1371%2Fjournal.pcbi.1007311",
+        "doi",
+        "10.1371/journal.pcbi.1007311",
+    ),
+    (
+        "https://elifesciences.org/download/aHR0cHM6Ly9jZG4uZWxpZmV/elife-50036-v1.pdf?_hash=gPY9lWM",
+        "doi",
+        "10.7554/eLife.50036",
+    ),
+    (
+        "http://www.jbc.org/content/early/2019/03/11/jbc.RA118.006805.full.pdf",
+        "doi",
+        "10.1074/jbc.RA118.006805",
+    ),
+    ("https://europepmc.org/articles/pmc4944528?pdf=render", "pmc", "PMC4944528"),
+    ("https://europepmc.org/articles/PMC4944528?pdf=render", "pmc", "PMC4944528"),
+    ("https://europepmc.org/article/PMC/4944528", "pmc", "PMC4944528"),
+    ("https://EuropePMC.org/Articles/PMC4944528", "pmc", "PMC4944528"),
+    (
+        "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/elink.fcgi?dbfrom=pubmed&amp;id="
+        "27357669&amp;retmode=ref&amp;cmd=prlinks",
+        "pubmed",
+        "27357669",
+    ),
+    (
+        "https://www.frontiersin.org/articles/10.3389/fphar.2019.00448/pdf",
+        "doi",
+        "10.3389/fphar.2019.00448",
+    ),
+    (
+        "https://www.biorxiv.org/content/10.1101/2020.03.27.001834v2",
+        "doi",
+        "10.1101/2020.03.27.001834",
+    ),
+    (
+        "https://www.preprints.org/manuscript/202003.0342/v3",
+        "doi",
+        "10.20944/preprints202003.0342",
+    ),
+    (
+        "10.21203/rs.3.rs-27212.v1",
+        "doi",
+        "10.21203/rs.3.rs-27212",
+    ),
+    (
+        "https://arxiv.org/abs/2006.13365",
+        "arxiv",
+        "2006.13365",
+    ),
+    (
+        "https://arxiv.org/pdf/2006.13365",
+        "arxiv",
+        "2006.13365",
+    ),
+    (
+        "https://arxiv.org/pdf/2006.13365.pdf",
+        "arxiv",
+        "2006.13365",
+    ),
+]
+
+#: URLs that don't contain enough information to get a standard identifier
+IRRECONCILABLE_URLS = [
+    "https://www.pnas.org/content/pnas/early/2020/06/24/2000648117.full.pdf",
+    "https://www.pnas.org/content/pnas/117/28/16500.full.pdf",
+    "https://www.cell.com/article/S245194561930073X/pdf",
+    "https://pdfs.semanticscholar.org/91fb/9d1827da26fe87ff232e310ab5b819bbb99f.pdf",
+    "http://www.jbc.org/content/294/21/8664.full.pdf",
+    "https://www.cell.com/cell-systems/fulltext/S2405-4712(17)30490-8",
+    "https://www.cell.com/cell/pdf/S0092-8674(20)30346-9.pdf",
+    "http://msb.embopress.org/content/13/11/954.full.pdf",
+    "https://msb.embopress.org/content/msb/11/3/797.full.pdf",
+]
+
+#: URLs that don't match any known pattern
+UNKNOWN_URLS = [
+    "https://example.com/true-garbage",
+    "http://www.jbc.org/content/early/pdf",
+    "http://www.jbc.org/content/early/2019/03",
+]
+
 
 class TestParse(unittest.TestCase):
     """Tests for parsing."""
@@ -28,7 +144,7 @@ class TestParse(unittest.TestCase):
         """Help test the prefixes don't include protocols."""
         for prefix in prefixes:
             with self.subTest(prefix=prefix):
-                self.assertFalse(any(prefix.startswith(protocol) for protocol in PROTOCOLS))
+                self.assertFalse(prefix.startswith(PROTOCOLS))
 
     def test_result_repr(self):
         """Test thee repr of a result."""
@@ -37,98 +153,54 @@ class TestParse(unittest.TestCase):
             repr(Result(status=Status.success, prefix="pubmed", identifier="34739845")),
         )
 
-    def test_parse(self):
+    @parameterized.expand(PARSE_DATA)
+    def test_parse(self, url: str, prefix: str, identifier: str):
         """Test parsing."""
-        data = [
-            (
-                "https://www.biorxiv.org/content/biorxiv/early/2020/03/30/2020.03.27.001834.full.pdf",
-                "doi",
-                "10.1101/2020.03.27.001834",
-            ),
-            (
-                "https://www.ncbi.nlm.nih.gov/pmc/articles/PMC5731347/pdf/MSB-13-954.pdf",
-                "pmc",
-                "PMC5731347",
-            ),
-            (
-                "10.21105/joss.01708.pdf",
-                "doi",
-                "10.21105/joss.01708",
-            ),
-            (
-                "https://joss.theoj.org/papers/10.21105/joss.01708.pdf",
-                "doi",
-                "10.21105/joss.01708",
-            ),
-            (
-                "https://journals.plos.org/ploscompbiol/article/file?id=10.1371/journal.pcbi.1007311&type=printable",
-                "doi",
-                "10.1371/journal.pcbi.1007311",
-            ),
-            (
-                "https://journals.plos.org/ploscompbiol/article/file?type=printable&id=10.1371/journal.pcbi.1007311",
-                "doi",
-                "10.1371/journal.pcbi.1007311",
-            ),
-            (
-                "https://elifesciences.org/download/aHR0cHM6Ly9jZG4uZWxpZmV/elife-50036-v1.pdf?_hash=gPY9lWM",
-                "doi",
-                "10.7554/eLife.50036",
-            ),
-            (
-                "http://www.jbc.org/content/early/2019/03/11/jbc.RA118.006805.full.pdf",
-                "doi",
-                "10.1074/jbc.RA118.006805",
-            ),
-            ("https://europepmc.org/articles/pmc4944528?pdf=render", "pmc", "PMC4944528"),
-            ("https://europepmc.org/articles/PMC4944528?pdf=render", "pmc", "PMC4944528"),
-            ("https://europepmc.org/article/PMC/4944528", "pmc", "PMC4944528"),
-            (
-                "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/elink.fcgi?dbfrom=pubmed&amp;id="
-                "27357669&amp;retmode=ref&amp;cmd=prlinks",
-                "pubmed",
-                "27357669",
-            ),
-            (
-                "https://www.frontiersin.org/articles/10.3389/fphar.2019.00448/pdf",
-                "doi",
-                "10.3389/fphar.2019.00448",
-            ),
-            (
-                "https://arxiv.org/abs/2006.13365",
-                "arxiv",
-                "2006.13365",
-            ),
-            (
-                "https://arxiv.org/pdf/2006.13365",
-                "arxiv",
-                "2006.13365",
-            ),
-            (
-                "https://arxiv.org/pdf/2006.13365.pdf",
-                "arxiv",
-                "2006.13365",
-            ),
-        ]
-        for url, prefix, identifier in data:
+        self.assertEqual(Result(Status.success, prefix, identifier), citation_url.parse(url))
+
+    def test_cached(self):
+        """Test that parsing the same URL twice gives back the cached result."""
+        url = "https://joss.theoj.org/papers/10.21105/joss.01708"
+        self.assertIs(citation_url.parse(url), citation_url.parse(url))
+
+    def test_strip_one_suffix(self):
+        """Test that only the outermost suffix is stripped, longest first."""
+        self.assertEqual(
+            Result(Status.success, "doi", "10.1/x"),
+            citation_url.parse("https://doi.org/10.1/x.full.pdf"),
+        )
+        self.assertEqual(
+            Result(Status.success, "doi", "10.1/x.article-metrics"),
+            citation_url.parse("https://doi.org/10.1/x.article-metrics.pdf"),
+        )
+
+    def test_version_only_at_end(self):
+        """Test that version tags are only stripped when they really end the identifier."""
+        for url in ["10.21203/x.v1\n", "10.21203/x.v\u0661"]:
             with self.subTest(url=url):
-                self.assertEqual(
-                    Result(Status.success, prefix, identifier), citation_url.parse(url)
-                )
+                self.assertEqual(Result(Status.success, "doi", url), citation_url.parse(url))
 
-    def test_unable_to_parse(self):
-        """Test URLs that don't have enough information to get a standard identifier."""
-        data = [
-            "https://www.pnas.org/content/pnas/early/2020/06/24/2000648117.full.pdf",
-            "https://www.pnas.org/content/pnas/117/28/16500.full.pdf",
-            "https://www.cell.com/article/S245194561930073X/pdf",
-            "https://pdfs.semanticscholar.org/91fb/9d1827da26fe87ff232e310ab5b819bbb99f.pdf",
-            "http://www.jbc.org/content/294/21/8664.full.pdf",
-            "https://www.cell.com/cell-systems/fulltext/S2405-4712(17)30490-8",
-            "https://www.cell.com/cell/pdf/S0092-8674(20)30346-9.pdf",
-            "http://msb.embopress.org/content/13/11/954.full.pdf",
-            "https://msb.embopress.org/content/msb/11/3/797.full.pdf",
+    def test_parse_many_workers(self):
+        """Test parsing in several processes gives the same results in the same order."""
+        urls = [
+            "https://joss.theoj.org/papers/10.21105/joss.01708",
+            "http://www.ncbi.nlm.nih.gov/pubmed/34739845",
+            "https://example.com/true-garbage",
+            "https://arxiv.org/abs/2006.13365",
         ]
-        for url in data:
-            with self.subTest(url=url):
-                self.assertEqual(Result(Status.irreconcilable, None, url), citation_url.parse(url))
+        self.assertEqual(citation_url.parse_many(urls), citation_url.parse_many(urls, workers=2))
+
+    def test_parse_many_invalid_workers(self):
+        """Test that a non-positive number of workers is rejected."""
+        with self.assertRaises(ValueError):
+            citation_url.parse_many(["https://arxiv.org/abs/2006.13365"], workers=0)
+
+    @parameterized.expand([(url,) for url in IRRECONCILABLE_URLS])
+    def test_unable_to_parse(self, url: str):
+        """Test URLs that don't have enough information to get a standard identifier."""
+        self.assertEqual(Result(Status.irreconcilable, None, url), citation_url.parse(url))
+
+    @parameterized.expand([(url,) for url in UNKNOWN_URLS])
+    def test_unknown(self, url: str):
+        """Test URLs that can't be parsed at all."""
+        self.assertEqual(Result(Status.unknown, None, url), citation_url.parse(url))